@@ -1,8 +1,18 @@
 import os
+import re
 import asyncio
 import logging
 import time
-import requests
+import bisect
+import heapq
+import weakref
+import contextlib
+from collections import deque
+from pathlib import Path
+import httpx
+import orjson
+import redis.asyncio as aioredis
+from cachetools import TTLCache
 from dotenv import load_dotenv
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
@@ -10,6 +20,11 @@ from telegram.ext import (
     MessageHandler, filters, ContextTypes
 )
 
+try:
+    import ahocorasick
+except ImportError:  # pyahocorasick not installed -> regex fallback
+    ahocorasick = None
+
 load_dotenv()
 
 # ── Logging ───────────────────────────────────────────────────────
@@ -24,6 +39,14 @@ BREATHING_PAGE_URL = os.getenv("BREATHING_PAGE_URL", "https://yourusername.githu
 OPENROUTER_SITE_URL = os.getenv("OPENROUTER_SITE_URL", "")
 OPENROUTER_APP_NAME = os.getenv("OPENROUTER_APP_NAME", "TelegramBot")
 
+# Webhook mode is used when WEBHOOK_URL is set, otherwise long polling
+WEBHOOK_URL    = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT   = int(os.getenv("WEBHOOK_PORT", "8443"))
+
+# Sessions live in Redis when REDIS_URL is set (shared across processes)
+REDIS_URL = os.getenv("REDIS_URL", "")
+
 print(f"🤖 Bot starting... TELEGRAM_TOKEN: {'✅' if TELEGRAM_TOKEN else '❌'}")
 print(f"🧠 OpenRouter key: {'✅' if OPENROUTER_API_KEY else '❌'}")
 
@@ -42,44 +65,92 @@ def _openrouter_headers() -> dict:
         headers["X-Title"] = OPENROUTER_APP_NAME
     return headers
 
+# Inputs are fixed after startup, so build the headers once
+_OPENROUTER_HEADERS = _openrouter_headers()
+
+
+# ── HTTP Clients ──────────────────────────────────────────────────
+# One long-lived pooled client for the chat hot path, so every call
+# reuses an open connection instead of paying a fresh TCP+TLS handshake.
+# HTTP/2 lets the parallel chat + stress-rater calls share one connection.
+_HTTPX_CLIENT = httpx.AsyncClient(
+    http2=True,
+    timeout=20,
+    limits=httpx.Limits(max_keepalive_connections=32, max_connections=64),
+    headers=_OPENROUTER_HEADERS,
+)
+# Sync client for the blocking startup fetch: short timeouts and no retries,
+# so a slow or unreachable OpenRouter can't hold up boot for long.
+_HTTPX_SYNC_CLIENT = httpx.Client(timeout=httpx.Timeout(4, connect=2), headers=_OPENROUTER_HEADERS)
+# Background refreshes don't block anything, so they can afford retries.
+_HTTPX_REFRESH_CLIENT = httpx.Client(
+    timeout=10,
+    headers=_OPENROUTER_HEADERS,
+    transport=httpx.HTTPTransport(retries=2),
+)
+
 
 # ── Auto-Fetch Free Models ────────────────────────────────────────
-def fetch_free_models() -> list:
+MODELS_CACHE_PATH = Path(os.getenv("MODELS_CACHE_PATH", "~/.cache/brainhealer/models.json")).expanduser()
+MODELS_REFRESH_SECONDS = int(os.getenv("MODELS_REFRESH_SECONDS", str(6 * 3600)))
+MODELS_RETRY_SECONDS   = int(os.getenv("MODELS_RETRY_SECONDS", "60"))
+FALLBACK_MODELS = ["openrouter/free", "liquid/lfm-2.5-1.2b-instruct:free", "google/gemma-3-27b-it:free"]
+
+def _load_cached_models() -> list:
+    try:
+        models = orjson.loads(MODELS_CACHE_PATH.read_bytes())
+        if isinstance(models, list) and models:
+            return models
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logger.warning(f"⚠️  Ignoring model cache {MODELS_CACHE_PATH}: {e}")
+    return []
+
+def _save_cached_models(models: list):
+    try:
+        MODELS_CACHE_PATH.parent.mkdir(parents=True, exist_ok=True)
+        MODELS_CACHE_PATH.write_bytes(orjson.dumps(models))
+    except Exception as e:
+        logger.warning(f"⚠️  Could not write model cache {MODELS_CACHE_PATH}: {e}")
+
+def fetch_free_models(client: httpx.Client = _HTTPX_SYNC_CLIENT) -> list:
     """
     Calls OpenRouter API to get all currently available free models.
+    Saves them to the disk cache on success; returns [] on failure.
     """
     logger.info("🔄 Fetching live free models from OpenRouter...")
     try:
-        resp = requests.get(OPENROUTER_MODELS_URL, headers=_openrouter_headers(), timeout=10)
+        resp = client.get(OPENROUTER_MODELS_URL)
         if resp.status_code == 200:
-            data = resp.json().get("data", [])
-            free_models = []
-            
-            for m in data:
-                pricing = m.get("pricing", {})
-                # A model is free if prompt and completion price are both "0"
-                if pricing.get("prompt") == "0" and pricing.get("completion") == "0":
-                    free_models.append(m["id"])
-            
-            # Always put the OpenRouter auto-router first
-            if "openrouter/free" not in free_models:
-                free_models.insert(0, "openrouter/free")
-            else:
-                free_models.remove("openrouter/free")
-                free_models.insert(0, "openrouter/free")
-                
+            data = orjson.loads(resp.content).get("data", [])
+            # A model is free if prompt and completion price are both "0".
+            # Always put the OpenRouter auto-router first.
+            free_models = ["openrouter/free"] + [
+                m["id"] for m in data
+                if (p := m.get("pricing") or {}).get("prompt") == "0"
+                and p.get("completion") == "0"
+                and m["id"] != "openrouter/free"
+            ]
+
             logger.info(f"✅ Found {len(free_models)} free models.")
+            _save_cached_models(free_models)
             return free_models
         else:
             logger.error(f"❌ Failed to fetch models: {resp.status_code}")
     except Exception as e:
         logger.error(f"❌ Error fetching models: {e}")
-    
-    # Safe fallback if API fails
-    return ["openrouter/free", "liquid/lfm-2.5-1.2b-instruct:free", "google/gemma-3-27b-it:free"]
-
-# Load them once at startup
-MODEL_PRIORITY = fetch_free_models()
+    return []
+
+# Startup: disk cache first, then a blocking fetch, then the safe fallback
+# if the API fails. Unless the live fetch worked, the list is re-fetched in
+# the background every MODELS_RETRY_SECONDS until a fetch succeeds.
+MODEL_PRIORITY = _load_cached_models()
+_MODELS_LIVE = False
+if not MODEL_PRIORITY:
+    MODEL_PRIORITY = fetch_free_models()
+    _MODELS_LIVE = bool(MODEL_PRIORITY)
+    MODEL_PRIORITY = MODEL_PRIORITY or list(FALLBACK_MODELS)
 print(f"🧩 Loaded {len(MODEL_PRIORITY)} models to cycle through.")
 
 
@@ -89,10 +160,61 @@ SYSTEM_PROMPT = (
     "Recommend professional help for serious issues. "
     "Keep replies under 150 words."
 )
+# Shared by every request; always placed first so providers can cache the prefix
+_SYSTEM_MSG = {"role": "system", "content": SYSTEM_PROMPT}
 
 # ── Session Storage ───────────────────────────────────────────────
-chat_sessions = {}
+# Bounded LRU with TTL: idle users are evicted so memory stays capped
+SESSION_MAX_USERS   = int(os.getenv("SESSION_MAX_USERS", "10000"))
+SESSION_TTL_SECONDS = int(os.getenv("SESSION_TTL_SECONDS", "3600"))
+chat_sessions = TTLCache(maxsize=SESSION_MAX_USERS, ttl=SESSION_TTL_SECONDS)
 HISTORY_PAIRS_TO_KEEP = 12 
+_MAX_HISTORY_MSGS = HISTORY_PAIRS_TO_KEEP * 2
+
+# With Redis, each session is a capped list at sess:<user_id> with the same TTL
+_redis = aioredis.Redis.from_url(REDIS_URL) if REDIS_URL else None
+
+async def _load_history(user_id: int) -> deque:
+    if _redis is not None:
+        raw = await _redis.lrange(f"sess:{user_id}", -_MAX_HISTORY_MSGS, -1)
+        if not raw:
+            print(f"New session for user {user_id}")
+        return deque((orjson.loads(m) for m in raw), maxlen=_MAX_HISTORY_MSGS)
+
+    history = chat_sessions.get(user_id)
+    if history is None:
+        # deque(maxlen) drops the oldest messages on append, no trimming needed
+        history = deque(maxlen=_MAX_HISTORY_MSGS)
+        print(f"New session for user {user_id}")
+    # Single write per turn; also refreshes the session TTL
+    chat_sessions[user_id] = history
+    return history
+
+async def _save_turn(user_id: int, *msgs: dict):
+    # In-memory history is the stored deque itself, already appended to
+    if _redis is None:
+        return
+    key = f"sess:{user_id}"
+    async with _redis.pipeline(transaction=True) as pipe:
+        pipe.rpush(key, *map(orjson.dumps, msgs))
+        pipe.ltrim(key, -_MAX_HISTORY_MSGS, -1)
+        pipe.expire(key, SESSION_TTL_SECONDS)
+        await pipe.execute()
+
+async def _clear_history(user_id: int):
+    if _redis is not None:
+        await _redis.delete(f"sess:{user_id}")
+    else:
+        chat_sessions.pop(user_id, None)
+
+# One lock per user with a turn in flight; idle locks drop out automatically
+_user_locks = weakref.WeakValueDictionary()
+
+def _user_lock(user_id: int) -> asyncio.Lock:
+    lock = _user_locks.get(user_id)
+    if lock is None:
+        lock = _user_locks[user_id] = asyncio.Lock()
+    return lock
 
 # ── Crisis Keywords ───────────────────────────────────────────────
 CRISIS_KEYWORDS = [
@@ -102,108 +224,230 @@ CRISIS_KEYWORDS = [
     "don't want to live", "dont want to live", "harm myself"
 ]
 
+def _keyword_matcher(keywords):
+    """
+    Compiles lowercase keywords into a single-pass, case-insensitive matcher
+    (Aho-Corasick if available, else one IGNORECASE regex alternation, which
+    skips the lowercased copy). Matches substrings, same as `in`.
+    """
+    if ahocorasick is not None:
+        automaton = ahocorasick.Automaton()
+        for kw in keywords:
+            automaton.add_word(kw, kw)
+        automaton.make_automaton()
+        return lambda text: next(automaton.iter(text.lower()), None) is not None
+
+    pattern = re.compile("|".join(map(re.escape, keywords)), re.IGNORECASE)
+    return lambda text: pattern.search(text) is not None
+
+def _is_word_char(c: str) -> bool:
+    return c.isalnum() or c == "_"
+
+def _keyword_scorer(lexicon: dict):
+    """
+    Like _keyword_matcher, but for a {score: [keywords]} lexicon and matching
+    whole words only ("panic" doesn't hit "Hispanic"). The returned callable
+    gives the highest score hit in the text, or 0.
+    """
+    scores = {kw: score for score, kws in lexicon.items() for kw in kws}
+    if ahocorasick is not None:
+        automaton = ahocorasick.Automaton()
+        for kw, score in scores.items():
+            automaton.add_word(kw, (len(kw), score))
+        automaton.make_automaton()
+
+        def score_text(text: str) -> int:
+            text = text.lower()
+            best = 0
+            for end, (length, score) in automaton.iter(text):
+                start = end - length + 1
+                if (start == 0 or not _is_word_char(text[start - 1])) and \
+                   (end + 1 == len(text) or not _is_word_char(text[end + 1])):
+                    best = max(best, score)
+            return best
+        return score_text
+
+    # Longest first so overlapping keywords resolve to the more specific one
+    alternation = "|".join(map(re.escape, sorted(scores, key=len, reverse=True)))
+    pattern = re.compile(rf"\b(?:{alternation})\b", re.IGNORECASE)
+    return lambda text: max((scores.get(m.lower(), 0) for m in pattern.findall(text)), default=0)
+
+_crisis_match = _keyword_matcher(CRISIS_KEYWORDS)
+
 def is_crisis(text: str) -> bool:
-    text_lower = (text or "").lower()
-    return any(kw in text_lower for kw in CRISIS_KEYWORDS)
+    return bool(text) and _crisis_match(text)
 
 # ── Per-model failure tracker ─────────────────────────────────────
+class _ModelState:
+    __slots__ = ("fails", "skip_until")
+
+    def __init__(self):
+        self.fails = 0
+        self.skip_until = 0.0
+
 _model_state: dict = {}
 MODEL_FAILURE_THRESHOLD = int(os.getenv("MODEL_FAILURE_THRESHOLD", "2"))
 MODEL_COOLDOWN_SECONDS  = int(os.getenv("MODEL_COOLDOWN_SECONDS", "60"))
 
+# Ready models are kept as sorted indices into MODEL_PRIORITY; cooled-down
+# ones sit in a (skip_until, index) min-heap until their cooldown expires.
+_MODEL_RANK = {model: i for i, model in enumerate(MODEL_PRIORITY)}
+_ready_ranks: list = sorted(_MODEL_RANK.values())
+_cooldown_heap: list = []
+
+def _set_model_priority(models: list):
+    global MODEL_PRIORITY, _MODEL_RANK, _ready_ranks, _cooldown_heap
+    MODEL_PRIORITY = models
+    _MODEL_RANK = {model: i for i, model in enumerate(models)}
+    _ready_ranks = sorted(_MODEL_RANK.values())
+    _cooldown_heap = []
+    _model_state.clear()
+
 def _mark_model_failed(model: str):
-    state = _model_state.setdefault(model, {"fails": 0, "skip_until": 0.0})
-    state["fails"] += 1
-    if state["fails"] >= MODEL_FAILURE_THRESHOLD:
-        state["skip_until"] = time.time() + MODEL_COOLDOWN_SECONDS
+    rank = _MODEL_RANK.get(model)
+    if rank is None:  # dropped by a model list refresh mid-request
+        return
+    state = _model_state.get(model)
+    if state is None:
+        state = _model_state[model] = _ModelState()
+    state.fails += 1
+    # skip_until is set while cooling, so concurrent failures don't re-queue it
+    if state.fails >= MODEL_FAILURE_THRESHOLD and not state.skip_until:
+        state.skip_until = time.time() + MODEL_COOLDOWN_SECONDS
+        del _ready_ranks[bisect.bisect_left(_ready_ranks, rank)]
+        heapq.heappush(_cooldown_heap, (state.skip_until, rank))
         logger.warning(f"🚫 {model} cooled down for {MODEL_COOLDOWN_SECONDS}s.")
 
-def _is_model_available(model: str) -> bool:
+def _mark_model_ok(model: str):
     state = _model_state.get(model)
-    if state is None:
-        return True
-    if time.time() >= state["skip_until"]:
-        state["fails"] = 0
-        state["skip_until"] = 0.0
-        return True
-    return False
+    if state is not None and not state.skip_until:
+        state.fails = 0
+
+def _release_cooled_models():
+    if not _cooldown_heap:
+        return
+    now = time.time()
+    while _cooldown_heap and _cooldown_heap[0][0] <= now:
+        _, rank = heapq.heappop(_cooldown_heap)
+        state = _model_state[MODEL_PRIORITY[rank]]
+        state.fails = 0
+        state.skip_until = 0.0
+        bisect.insort(_ready_ranks, rank)
+
+# ── Chat ──────────────────────────────────────────────────────────
+# If a model hasn't answered after HEDGE_DELAY_SECONDS, the next one is fired
+# in parallel; the first usable reply wins and the other request is cancelled.
+HEDGE_DELAY_SECONDS = float(os.getenv("HEDGE_DELAY_SECONDS", "2.0"))
+HEDGE_MAX_IN_FLIGHT = 2
+
+async def _try_model(model: str, messages, user_id: str, max_tokens: int, temperature: float):
+    """
+    One attempt against one model. Returns the reply, or None if the model
+    failed and the next one should be tried. Raises on auth errors.
+    """
+    payload = {
+        "model":       model,
+        "messages":    messages,
+        "temperature": temperature,
+        "max_tokens":  max_tokens,
+        "user":        user_id,
+    }
 
-# ── Chat Sync & Async ─────────────────────────────────────────────
-def _openrouter_chat_sync(messages, user_id: str, max_tokens: int, temperature: float) -> str:
+    try:
+        # Content-Type: application/json is already set on the client
+        resp = await _HTTPX_CLIENT.post(OPENROUTER_CHAT_URL, content=orjson.dumps(payload))
+
+        if resp.status_code == 200:
+            data = orjson.loads(resp.content)
+            content = ((data.get("choices", [{}])[0].get("message") or {}).get("content") or "")
+            if content.strip():
+                _mark_model_ok(model)
+                used_model = (data.get("model") or model)
+                logger.info(f"✅ Response from: {used_model}")
+                return content
+
+        # 404 (Not Found), 429 (Rate Limit), or 5xx (Server Error) -> Skip model safely
+        if resp.status_code in [404, 410, 429, 500, 502, 503, 504]:
+            logger.warning(f"⚠️  {model} → HTTP {resp.status_code}. Skipping.")
+            _mark_model_failed(model)
+            return None
+
+        # Auth Error
+        if resp.status_code in [401, 403]:
+            raise RuntimeError(f"OpenRouter Auth Error: {resp.text[:100]}")
+
+        # Other unknown errors -> skip safely
+        logger.warning(f"⚠️  {model} → HTTP {resp.status_code}. Body: {resp.text[:100]}")
+        _mark_model_failed(model)
+        return None
+
+    except RuntimeError:
+        raise
+    except Exception as e:
+        logger.warning(f"⚠️  {model} connection error: {e}. Trying next...")
+        _mark_model_failed(model)
+        return None
+
+async def _openrouter_chat(messages, user_id: str, max_tokens: int, temperature: float) -> str:
     if not OPENROUTER_API_KEY:
         raise RuntimeError("OPENROUTER_API_KEY missing")
 
+    _release_cooled_models()
+
+    # Snapshot: failures, concurrent calls and list refreshes mutate the tracker
+    models = iter([MODEL_PRIORITY[rank] for rank in _ready_ranks])
+    pending = set()
     tried = 0
-    for model in MODEL_PRIORITY:
-        if not _is_model_available(model):
-            continue
 
+    def launch_next() -> bool:
+        nonlocal tried
+        model = next(models, None)
+        if model is None:
+            return False
         tried += 1
-        payload = {
-            "model":       model,
-            "messages":    messages,
-            "temperature": temperature,
-            "max_tokens":  max_tokens,
-            "user":        user_id,
-        }
+        pending.add(asyncio.create_task(_try_model(model, messages, user_id, max_tokens, temperature)))
+        return True
 
-        try:
-            resp = requests.post(
-                OPENROUTER_CHAT_URL,
-                headers=_openrouter_headers(),
-                json=payload,
-                timeout=20,
+    try:
+        launch_next()
+        while pending:
+            can_hedge = len(pending) < HEDGE_MAX_IN_FLIGHT
+            done, _ = await asyncio.wait(
+                pending,
+                timeout=HEDGE_DELAY_SECONDS if can_hedge else None,
+                return_when=asyncio.FIRST_COMPLETED,
             )
-
-            if resp.status_code == 200:
-                data = resp.json()
-                content = ((data.get("choices", [{}])[0].get("message") or {}).get("content") or "")
-                if content.strip():
-                    if model in _model_state:
-                        _model_state[model] = {"fails": 0, "skip_until": 0.0}
-                    used_model = (data.get("model") or model)
-                    logger.info(f"✅ Response from: {used_model}")
-                    return content
-
-            # 404 (Not Found), 429 (Rate Limit), or 5xx (Server Error) -> Skip model safely
-            if resp.status_code in [404, 410, 429, 500, 502, 503, 504]:
-                logger.warning(f"⚠️  {model} → HTTP {resp.status_code}. Skipping.")
-                _mark_model_failed(model)
+            if not done:
+                # Slow but alive: hedge with the next model
+                launch_next()
                 continue
-
-            # Auth Error
-            if resp.status_code in [401, 403]:
-                raise RuntimeError(f"OpenRouter Auth Error: {resp.text[:100]}")
-
-            # Other unknown errors -> skip safely
-            logger.warning(f"⚠️  {model} → HTTP {resp.status_code}. Body: {resp.text[:100]}")
-            _mark_model_failed(model)
-            continue
-
-        except RuntimeError:
-            raise
-        except Exception as e:
-            logger.warning(f"⚠️  {model} connection error: {e}. Trying next...")
-            _mark_model_failed(model)
-            continue
+            for task in done:
+                pending.discard(task)
+                content = task.result()
+                if content is not None:
+                    return content
+                # Failed: replace it with the next model right away
+                launch_next()
+    finally:
+        for task in pending:
+            task.cancel()
 
     raise RuntimeError(f"All {tried} available models failed or are in cooldown. Try again soon.")
 
 async def openrouter_chat(messages, user_id: str, max_tokens: int = 220, temperature: float = 0.7) -> str:
-    return await asyncio.to_thread(_openrouter_chat_sync, messages, user_id, max_tokens, temperature)
+    return await _openrouter_chat(messages, user_id, max_tokens, temperature)
 
 
 # ── Stress Rater ──────────────────────────────────────────────────
+_RATER_SYSTEM_MSG = {"role": "system", "content": "You output only a single digit 1-5."}
+
 async def get_stress_level(user_text: str, user_id: str) -> int:
     prompt = (
         "You are a mental health triage assistant.\n"
         "Rate emotional distress 1-5. 5=crisis/self-harm. Reply ONLY with 1 digit.\n"
         f"Message: \"{user_text}\""
     )
-    messages = [
-        {"role": "system", "content": "You output only a single digit 1-5."},
-        {"role": "user", "content": prompt},
-    ]
+    messages = [_RATER_SYSTEM_MSG, {"role": "user", "content": prompt}]
     try:
         txt = await openrouter_chat(messages, user_id=user_id, max_tokens=3, temperature=0.0)
         raw = (txt or "").strip()
@@ -215,8 +459,69 @@ async def get_stress_level(user_text: str, user_id: str) -> int:
         logger.warning(f"Stress rater failed: {e}")
     return 1
 
+# Local triage: clear-cut messages are rated from keywords without a remote
+# call. Keywords match whole words, so inflections are listed explicitly.
+# Level 5 is never assigned here; crisis messages are caught before this.
+_STRESS_LEXICON = {
+    2: ["stress", "stressed", "stressful", "tired", "upset", "worried", "worrying",
+        "angry", "frustrated", "lonely", "sad", "cry", "crying", "hurt", "hurting"],
+    3: ["anxious", "anxiety", "overwhelmed", "overwhelming", "panic", "panicking",
+        "scared", "afraid", "depressed", "depression", "feel alone", "so alone",
+        "all alone", "feel lost", "broken", "heartbroken", "exhausted"],
+    4: ["hopeless", "worthless", "can't cope", "cant cope", "can't take it", "cant take it",
+        "falling apart", "no one cares", "nobody cares", "empty inside"],
+}
+LOCAL_RATER_SHORT_MESSAGE_CHARS = 80   # up to this, weak/no hits are trusted
+LOCAL_RATER_LONG_MESSAGE_CHARS  = 300  # long venting bumps the level by one
+
+_stress_score = _keyword_scorer(_STRESS_LEXICON)
+
+def _local_stress_level(text: str):
+    """
+    Returns a 1-4 stress level from keywords, or None when the local score
+    isn't confident (longer message with only a weak or no keyword hit) and
+    the remote rater should decide.
+    """
+    level = _stress_score(text)
+    if level >= 3:
+        if len(text) > LOCAL_RATER_LONG_MESSAGE_CHARS:
+            level = min(level + 1, 4)
+        return level
+    if len(text) <= LOCAL_RATER_SHORT_MESSAGE_CHARS:
+        return level or 1
+    return None
+
+
+async def _refresh_models(context: ContextTypes.DEFAULT_TYPE):
+    models = await asyncio.to_thread(fetch_free_models, _HTTPX_REFRESH_CLIENT)
+    if models:
+        _set_model_priority(models)
+        logger.info(f"🧩 Refreshed model list: {len(models)} models.")
+        # Live list is in place: stop the fast startup retries
+        if context.job.name == "models-retry":
+            context.job.schedule_removal()
+
+
+async def _close_http_clients(app):
+    await _HTTPX_CLIENT.aclose()
+    _HTTPX_SYNC_CLIENT.close()
+    _HTTPX_REFRESH_CLIENT.close()
+    if _redis is not None:
+        await _redis.aclose()
+
 
 # ── Telegram Handlers ─────────────────────────────────────────────
+# Constant replies, built once
+_CRISIS_REPLY = (
+    "💚 I hear you, and I'm really glad you reached out.\n\n"
+    "What you're feeling right now is serious, and you deserve real support. "
+    "Please reach out to a crisis helpline immediately:\n\n"
+    "🇮🇳 *iCall (India):* 9152987821\n"
+    "🌍 *Crisis Text Line:* Text HOME to 741741\n\n"
+    "You are not alone. 💚"
+)
+_BREATHING_KEYBOARD = InlineKeyboardMarkup([[InlineKeyboardButton("🌸 Breathing Exercise", url=BREATHING_PAGE_URL)]])
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
         "💚 Hi! I'm your Mental Health Companion.\n\n"
@@ -227,12 +532,10 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def clear(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    chat_sessions.pop(user_id, None)
-    await update.message.reply_text("✅ Conversation cleared! Fresh start 💚")
-
-def _trim_history(history: list) -> list:
-    max_msgs = HISTORY_PAIRS_TO_KEEP * 2
-    return history if len(history) <= max_msgs else history[-max_msgs:]
+    # Wait for any in-flight turn, so it can't write history back after the clear
+    async with _user_lock(user_id):
+        await _clear_history(user_id)
+        await update.message.reply_text("✅ Conversation cleared! Fresh start 💚")
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id_int = update.effective_user.id
@@ -243,52 +546,46 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ OPENROUTER_API_KEY missing from .env")
         return
 
-    try:
-        if user_id_int not in chat_sessions:
-            chat_sessions[user_id_int] = []
-            print(f"New session for user {user_id_int}")
-
-        await context.bot.send_chat_action(chat_id=update.effective_chat.id, action="typing")
-
-        if is_crisis(user_text):
-            crisis_reply = (
-                "💚 I hear you, and I'm really glad you reached out.\n\n"
-                "What you're feeling right now is serious, and you deserve real support. "
-                "Please reach out to a crisis helpline immediately:\n\n"
-                "🇮🇳 *iCall (India):* 9152987821\n"
-                "🌍 *Crisis Text Line:* Text HOME to 741741\n\n"
-                "You are not alone. 💚"
-            )
-            keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("🌸 Breathing Exercise", url=BREATHING_PAGE_URL)]])
-            await update.message.reply_text(crisis_reply, parse_mode="Markdown", reply_markup=keyboard)
-            return
+    # Serialize turns per user so rapid messages don't race on history
+    async with _user_lock(user_id_int):
+        try:
+            history = await _load_history(user_id_int)
 
-        history = chat_sessions[user_id_int]
-        history.append({"role": "user", "content": user_text})
-        history = _trim_history(history)
-        chat_sessions[user_id_int] = history
+            await context.bot.send_chat_action(chat_id=update.effective_chat.id, action="typing")
 
-        messages = [{"role": "system", "content": SYSTEM_PROMPT}] + history
+            if is_crisis(user_text):
+                await update.message.reply_text(_CRISIS_REPLY, parse_mode="Markdown", reply_markup=_BREATHING_KEYBOARD)
+                return
 
-        stress_level, reply = await asyncio.gather(
-            get_stress_level(user_text, user_id=user_id),
-            openrouter_chat(messages, user_id=user_id, max_tokens=220, temperature=0.7),
-        )
+            user_msg = {"role": "user", "content": user_text}
+            history.append(user_msg)
 
-        reply = (reply or "").strip() or "I'm here for you. Could you share more?"
-        history.append({"role": "assistant", "content": reply})
-        chat_sessions[user_id_int] = _trim_history(history)
+            messages = [_SYSTEM_MSG, *history]
 
-        if stress_level >= 3:
-            keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("🌸 Breathing Exercise", url=BREATHING_PAGE_URL)]])
-            await update.message.reply_text(reply, reply_markup=keyboard)
-        else:
-            await update.message.reply_text(reply)
+            stress_level = _local_stress_level(user_text)
+            if stress_level is None:
+                stress_level, reply = await asyncio.gather(
+                    get_stress_level(user_text, user_id=user_id),
+                    openrouter_chat(messages, user_id=user_id, max_tokens=220, temperature=0.7),
+                )
+            else:
+                reply = await openrouter_chat(messages, user_id=user_id, max_tokens=220, temperature=0.7)
 
-    except Exception as e:
-        logger.error(f"❌ Error for user {user_id_int}: {e}")
-        chat_sessions.pop(user_id_int, None)
-        await update.message.reply_text("Sorry, something went wrong. Try /clear and send your message again.")
+            reply = (reply or "").strip() or "I'm here for you. Could you share more?"
+            assistant_msg = {"role": "assistant", "content": reply}
+            history.append(assistant_msg)
+            await _save_turn(user_id_int, user_msg, assistant_msg)
+
+            if stress_level >= 3:
+                await update.message.reply_text(reply, reply_markup=_BREATHING_KEYBOARD)
+            else:
+                await update.message.reply_text(reply)
+
+        except Exception as e:
+            logger.error(f"❌ Error for user {user_id_int}: {e}")
+            with contextlib.suppress(Exception):
+                await _clear_history(user_id_int)
+            await update.message.reply_text("Sorry, something went wrong. Try /clear and send your message again.")
 
 if __name__ == "__main__":
     if not TELEGRAM_TOKEN:
@@ -296,10 +593,31 @@ if __name__ == "__main__":
     if not OPENROUTER_API_KEY:
         print("❌ OPENROUTER_API_KEY missing from .env"); exit(1)
 
-    app = ApplicationBuilder().token(TELEGRAM_TOKEN).build()
+    # Updates from different users are handled concurrently; the per-user
+    # lock in handle_message keeps each user's turns in order
+    app = (
+        ApplicationBuilder()
+        .token(TELEGRAM_TOKEN)
+        .concurrent_updates(True)
+        .post_shutdown(_close_http_clients)
+        .build()
+    )
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("clear", clear))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    app.job_queue.run_repeating(_refresh_models, interval=MODELS_REFRESH_SECONDS, first=MODELS_REFRESH_SECONDS)
+    if not _MODELS_LIVE:
+        # Started from the disk cache or the fallback list: fetch soon, and
+        # keep retrying quickly until a live list is loaded
+        app.job_queue.run_repeating(_refresh_models, interval=MODELS_RETRY_SECONDS, first=0, name="models-retry")
 
     print("🚀 Bot is running... Send /start on Telegram!")
-    app.run_polling()
+    if WEBHOOK_URL:
+        app.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=TELEGRAM_TOKEN,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{TELEGRAM_TOKEN}",
+        )
+    else:
+        app.run_polling()